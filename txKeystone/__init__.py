@@ -1,3 +1,7 @@
 from txKeystone.keystone import KeystoneAgent
+from txKeystone.upload import SegmentedUploader
+from txKeystone.download import RangedDownloader
+from txKeystone.resolver import CachingResolver
 
-__all__ = ['KeystoneAgent']
+__all__ = ['KeystoneAgent', 'SegmentedUploader', 'RangedDownloader',
+           'CachingResolver']
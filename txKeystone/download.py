@@ -0,0 +1,419 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+from twisted.internet.defer import (Deferred, DeferredList,
+                                    DeferredSemaphore, fail)
+from twisted.internet.protocol import Protocol
+from twisted.internet.task import cooperate, deferLater
+from twisted.web.client import ResponseDone
+from twisted.web.http_headers import Headers
+from twisted.python import log
+
+from txKeystone.keystone import getETag
+
+_MD5_ETAG = re.compile('^[0-9a-f]{32}$')
+_CONTENT_RANGE = re.compile('^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+
+class RangedDownloader(object):
+    """
+    Downloads large objects through a L{KeystoneAgent} as a number of
+    concurrent C{Range} GETs, each written straight into its place in a
+    preallocated file as the data arrive.
+
+    A range which fails part way through is retried on its own, resuming
+    from the last byte received, so an expired token or a dropped connection
+    only costs the data which were in flight. Every GET is conditional on
+    the ETag returned by the initial HEAD, so an object which is replaced
+    part way through fails the download instead of being stitched together
+    from both versions. If the server doesn't
+    advertise C{Accept-Ranges: bytes} the object is fetched with a single
+    GET instead.
+
+    @cvar RANGE_SIZE: Default number of bytes requested by each GET.
+    @cvar CONCURRENCY: Default number of ranges downloaded at once.
+    @cvar MAX_RETRIES: Default number of attempts made for each range
+                       before failing the download.
+    @cvar IDLE_TIMEOUT: Default number of seconds a range may go without
+                        receiving any data before it is retried.
+    """
+    RANGE_SIZE = 64 * 1024 * 1024
+    CONCURRENCY = 4
+    MAX_RETRIES = 3
+
+    IDLE_TIMEOUT = 60
+
+    def __init__(self, agent, range_size=None, concurrency=None,
+                 max_retries=None, retry_delay=1.0, verify=True,
+                 timeout=None, idle_timeout=None, verbose=False,
+                 reactor=None):
+        """
+        @param agent: L{KeystoneAgent} used to make requests
+        @param range_size: Number of bytes requested by each GET.
+        @param concurrency: Maximum number of ranges downloaded at once.
+        @param max_retries: Maximum number of attempts for each range.
+        @param retry_delay: Seconds to wait before retrying a range.
+        @param verify: Check the MD5 of the downloaded file against the
+                       object's ETag, True by default. Static and dynamic
+                       large objects, whose ETag is not the MD5 of their
+                       contents, are not checked.
+        @param timeout: Deadline in seconds for the response headers of each
+                        request to arrive, passed on to
+                        L{KeystoneAgent.request}. It does not cover
+                        receiving the body, see C{idle_timeout}.
+        @param idle_timeout: Number of seconds a range may go without
+                             receiving any data before it is abandoned and
+                             retried from the last byte received.
+        @param verbose: Enable verbose logging, False by default.
+        @param reactor: Reactor used to schedule retries, the global
+                        reactor by default.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.agent = agent
+        self.range_size = range_size or self.RANGE_SIZE
+        self.concurrency = concurrency or self.CONCURRENCY
+        self.max_retries = max_retries or self.MAX_RETRIES
+        self.retry_delay = retry_delay
+        self.verify = verify
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout or self.IDLE_TIMEOUT
+        self.verbose = verbose
+        self.reactor = reactor
+
+    def msg(self, msg, **kwargs):
+        if self.verbose:
+            log.msg(format=msg, system="RangedDownloader", **kwargs)
+
+    def download(self, uri, path):
+        """
+        @param uri: URL of the object to download
+        @type uri: C{str}
+        @param path: Path of the local file to write, which is created or
+        truncated.
+        @type path: C{str}
+        @return: A L{Deferred} which fires with the L{Response} to the
+        initial HEAD request once the whole object has been written to
+        C{path}. It fails with L{DownloadError} if the server rejects a
+        request or the file doesn't match the object's ETag, and with
+        L{ObjectModifiedError} if the object is replaced while it is being
+        downloaded. Other failures,
+        such as a connection which is lost once too often or a local file
+        which can't be written, are passed through unchanged.
+        """
+        def _handleHead(response):
+            if response.code != 200:
+                raise DownloadError("HEAD %s failed: %s %s" %
+                                    (uri, response.code, response.phrase))
+
+            length = response.headers.getRawHeaders('content-length')
+            if not length:
+                raise DownloadError("HEAD %s did not return a"
+                                    " Content-Length" % (uri,))
+
+            size = int(length[0])
+            self.msg("download: %(uri)s (%(size)s bytes) to %(path)s",
+                     uri=uri, size=size, path=path)
+
+            etag = response.headers.getRawHeaders('etag', [None])[0]
+            checksum = getETag(response)
+            if (response.headers.hasHeader('x-static-large-object') or
+                    response.headers.hasHeader('x-object-manifest')):
+                # The ETag of a large object is the MD5 of its segments'
+                # ETags, not of its contents, so there is nothing to check
+                checksum = None
+
+            accept_ranges = response.headers.getRawHeaders('accept-ranges')
+            ranged = 'bytes' in ''.join(accept_ranges or []).split(',')
+            if not ranged:
+                self.msg("download: %(uri)s doesn't support ranges",
+                         uri=uri)
+
+            d = self._download(uri, path, size, etag, checksum, ranged)
+            d.addCallback(lambda _: response)
+            return d
+
+        # A HEAD response has no body, and some versions of Twisted never
+        # finish delivering it, so don't try to read it
+        d = self._request('HEAD', uri, Headers({}))
+        d.addCallback(_handleHead)
+        return d
+
+    def _download(self, uri, path, size, etag, checksum, ranged):
+        try:
+            outputFile = open(path, 'w+b')
+            # Preallocate, so every range can be written in place
+            outputFile.truncate(size)
+        except (IOError, OSError), e:
+            return fail(e)
+
+        semaphore = DeferredSemaphore(self.concurrency)
+        failed = []
+        range_size = self.range_size if ranged else max(size, 1)
+
+        def _downloadRange(offset, length):
+            if failed:
+                # Another range has already failed the download,
+                # don't bother fetching the rest
+                return fail(DownloadError("Download of bytes %d-%d"
+                                          " abandoned" %
+                                          (offset, offset + length - 1)))
+
+            d = self._getRange(uri, outputFile, offset, length, etag)
+
+            def _rangeFailed(failure):
+                failed.append(failure)
+                return failure
+
+            d.addErrback(_rangeFailed)
+            return d
+
+        dl = DeferredList([semaphore.run(_downloadRange, offset,
+                                         min(range_size, size - offset))
+                           for offset in range(0, size, range_size)],
+                          consumeErrors=True)
+
+        def _rangesDone(_):
+            if failed:
+                outputFile.close()
+                return failed[0]
+
+            if (not self.verify or checksum is None or
+                    not _MD5_ETAG.match(checksum)):
+                outputFile.close()
+                return
+
+            d = _checksumFile(outputFile)
+
+            def _verify(received):
+                outputFile.close()
+                if received != checksum:
+                    raise DownloadError("%s corrupted in transit: expected"
+                                        " MD5 %s got %s" %
+                                        (uri, checksum, received))
+
+            d.addCallback(_verify)
+            return d
+
+        dl.addCallback(_rangesDone)
+        return dl
+
+    def _request(self, method, uri, headers):
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+
+        return self.agent.request(method, uri, headers, None, **kwargs)
+
+    def _getRange(self, uri, outputFile, offset, length, etag, attempt=1):
+        self.msg("_getRange attempt %(attempt)s: bytes %(start)s-%(end)s",
+                 attempt=attempt, start=offset, end=offset + length - 1)
+
+        receiver = _RangeReceiver(outputFile, offset, length,
+                                  self.idle_timeout, self.reactor)
+        whole = []
+
+        def _handleResponse(response):
+            if response.code == 206:
+                content_range = response.headers.getRawHeaders(
+                    'content-range')
+                match = content_range and _CONTENT_RANGE.match(
+                    content_range[0])
+                if not match or int(match.group(1)) != offset:
+                    # Don't read a body we can't use, it could be the
+                    # whole object
+                    response.deliverBody(_Discard())
+                    raise DownloadError("Unexpected Content-Range %s for"
+                                        " bytes %d-%d" %
+                                        (content_range, offset,
+                                         offset + length - 1))
+            elif response.code == 412:
+                response.deliverBody(_Discard())
+                raise ObjectModifiedError("%s no longer matches ETag %s" %
+                                          (uri, etag))
+            elif response.code == 200 and offset == 0:
+                # The Range was ignored, and the whole object is on its
+                # way. Keep the start of it, and don't resume from the
+                # middle of it if it fails
+                whole.append(True)
+            else:
+                response.deliverBody(_Discard())
+                raise DownloadError("GET %s bytes %d-%d rejected: %s %s" %
+                                    (uri, offset, offset + length - 1,
+                                     response.code, response.phrase))
+
+            response.deliverBody(receiver)
+            return receiver.finished
+
+        def _retry(failure):
+            if failure.check(ObjectModifiedError):
+                # Retrying would only fetch more of the new version
+                return failure
+
+            if attempt >= self.max_retries:
+                self.msg("_getRange: bytes %(start)s-%(end)s failed after"
+                         " %(attempt)s attempts", start=offset,
+                         end=offset + length - 1, attempt=attempt)
+                return failure
+
+            # Only ask for what we didn't get last time
+            received = receiver.received
+            if whole:
+                received = 0
+            self.msg("_getRange: bytes %(start)s-%(end)s failed after"
+                     " %(received)s bytes (%(failure)s), retrying",
+                     start=offset, end=offset + length - 1,
+                     received=received, failure=failure.getErrorMessage())
+
+            return deferLater(self.reactor, self.retry_delay,
+                              self._getRange, uri, outputFile,
+                              offset + received, length - received,
+                              etag, attempt + 1)
+
+        headers = Headers({"Range": ['bytes=%d-%d' %
+                                     (offset, offset + length - 1)]})
+        if etag is not None:
+            headers.setRawHeaders('If-Match', [etag])
+        d = self._request('GET', uri, headers)
+        d.addCallback(_handleResponse)
+        d.addErrback(_retry)
+        return d
+
+
+class DownloadError(Exception):
+    pass
+
+
+class ObjectModifiedError(DownloadError):
+    """
+    The object was replaced while it was being downloaded.
+    """
+
+
+class _Discard(Protocol):
+    """
+    A protocol which drops the connection instead of reading a response
+    body nobody wants.
+    """
+    def connectionMade(self):
+        self.transport.stopProducing()
+
+
+class _RangeReceiver(Protocol):
+    """
+    A protocol which writes the body of a range response into C{outputFile}
+    at the range's offset as it is received, and fires C{finished} once all
+    C{length} bytes have been written. Should the body be longer than that
+    the connection is dropped once they have arrived.
+
+    If no data arrive for C{idle_timeout} seconds the connection is dropped
+    and C{finished} fails with L{DownloadError}, so a stalled range doesn't
+    hold up the download forever.
+    """
+    def __init__(self, outputFile, offset, length, idle_timeout, reactor):
+        """
+        @param outputFile: File to write to, shared with the other ranges.
+        @param offset: Position in the file of the first byte of the range.
+        @param length: Number of bytes in the range.
+        @param idle_timeout: Seconds to wait for more data.
+        @param reactor: Reactor used to schedule the idle timeout.
+        """
+        self.outputFile = outputFile
+        self.offset = offset
+        self.length = length
+        self.idle_timeout = idle_timeout
+        self.reactor = reactor
+        self.received = 0
+        self.finished = Deferred()
+
+        self._idle = None
+
+    def connectionMade(self):
+        self._idle = self.reactor.callLater(self.idle_timeout, self._expire)
+
+    def _expire(self):
+        self._idle = None
+        self.finished.errback(DownloadError("No data received for %s"
+                                            " seconds after %d of %d bytes" %
+                                            (self.idle_timeout,
+                                             self.received, self.length)))
+        self.transport.stopProducing()
+
+    def dataReceived(self, data):
+        if self._idle is None:
+            # Already given up on this response
+            return
+
+        self._idle.reset(self.idle_timeout)
+
+        remaining = self.length - self.received
+        overflow = len(data) > remaining
+        if overflow:
+            data = data[:remaining]
+        self.outputFile.seek(self.offset + self.received)
+        self.outputFile.write(data)
+        self.received += len(data)
+
+        if overflow:
+            # Got everything we asked for, don't wait for the rest
+            self._idle.cancel()
+            self._idle = None
+            self.finished.callback(None)
+            self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        if self._idle is None:
+            return
+
+        self._idle.cancel()
+        self._idle = None
+
+        if self.received < self.length:
+            if reason.check(ResponseDone):
+                reason = DownloadError("Range ended after %d of %d bytes" %
+                                       (self.received, self.length))
+            self.finished.errback(reason)
+        else:
+            self.finished.callback(None)
+
+
+def _checksumFile(inputFile, readSize=2 ** 16):
+    """
+    Calculate the MD5 of C{inputFile} a chunk at a time, cooperatively, so
+    the reactor isn't blocked while hashing a large file.
+
+    @return: A L{Deferred} which fires with the hex digest.
+    """
+    checksum = md5()
+
+    def _hash():
+        inputFile.seek(0)
+        while True:
+            data = inputFile.read(readSize)
+            if not data:
+                break
+            checksum.update(data)
+            yield None
+
+    d = cooperate(_hash()).whenDone()
+    d.addCallback(lambda _: checksum.hexdigest())
+    return d
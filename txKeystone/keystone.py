@@ -20,12 +20,12 @@ except:
     import json
 
 from cStringIO import StringIO
-from Queue import Queue
 from twisted.internet.defer import Deferred, succeed, fail
 from twisted.internet.protocol import Protocol
 from twisted.web.client import FileBodyProducer
 from twisted.web.http_headers import Headers
 from twisted.python import log
+from twisted.python.failure import Failure
 
 
 class KeystoneAgent(object):
@@ -38,6 +38,9 @@ class KeystoneAgent(object):
                         containing current authentication header data.
     @cvar MAX_RETRIES: Maximum number of connection attempts to make
                        before failing.
+    @ivar timeout: Default number of seconds a call to L{request} may take,
+                   including any time spent authenticating, or None for
+                   no limit.
     """
     MAX_RETRIES = 3
 
@@ -46,7 +49,7 @@ class KeystoneAgent(object):
     AUTHENTICATED = 3
 
     def __init__(self, agent, auth_url, auth_cred, auth_type='api_key',
-                 verbose=False):
+                 verbose=False, timeout=None, reactor=None):
         """
         @param agent: Agent for use by this class
         @param auth_url: URL to use for Keystone authentication
@@ -55,23 +58,34 @@ class KeystoneAgent(object):
         @param auth_type: Either api_key or password, depending on what
                           you want to use to authenticate.
         @param verbose: Enable verbose logging, False by default.
+        @param timeout: Default deadline in seconds for requests made with
+                        this agent, None (no deadline) by default.
+        @param reactor: Reactor used to schedule deadlines, the global
+                        reactor by default.
         """
+        if reactor is None:
+            from twisted.internet import reactor
+
         self.agent = agent
         self.auth_url = auth_url
         self.auth_cred = auth_cred
         self.auth_type = auth_type
         self.verbose = verbose
+        self.timeout = timeout
+        self.reactor = reactor
 
         self.auth_headers = {"X-Auth-Token": None, "X-Tenant-Id": None}
 
         self._state = self.NOT_AUTHENTICATED
-        self._headers_requests = Queue()
+        self._headers_requests = []
+        self._auth_request = None
 
     def msg(self, msg, **kwargs):
         if self.verbose:
             log.msg(format=msg, system="KeystoneAgent", **kwargs)
 
-    def request(self, method, uri, headers=None, bodyProducer=None):
+    def request(self, method, uri, headers=None, bodyProducer=None,
+                timeout=None):
         """
         @param method: The request method to send ("GET", "POST", etc.)
         @type method: C{str}
@@ -82,16 +96,65 @@ class KeystoneAgent(object):
         @param bodyProducer: An object which will produce the request body or,
         if the request body is to be empty, None.
         @type bodyProducer: L{IBodyProducer} provider
+        @param timeout: Number of seconds the whole operation may take,
+        covering time spent waiting for authentication and any retries.
+        Defaults to the agent's C{timeout}.
+        @type timeout: C{float}
         @return: A L{Deferred} which fires with the result of the request (a
         Response instance), or fails if there is a problem setting up a
-        connection over which to issue the request.
+        connection over which to issue the request. Fails with
+        L{RequestTimeoutError} if the deadline passes first.
         """
         self.msg("request (%(method)s): %(uri)s", method=method, uri=uri)
 
-        return self._request(method,
-                             uri,
-                             headers=headers,
-                             bodyProducer=bodyProducer)
+        if timeout is None:
+            timeout = self.timeout
+
+        d = self._request(method,
+                          uri,
+                          headers=headers,
+                          bodyProducer=bodyProducer)
+
+        if timeout is None:
+            return d
+
+        return self._withTimeout(d, timeout, method, uri)
+
+    def _withTimeout(self, d, timeout, method, uri):
+        """
+        Cancel C{d} if it has not fired within C{timeout} seconds.
+
+        Cancellation follows the chain of Deferreds, so whichever phase is
+        in progress (waiting for auth headers, the auth request itself, or
+        the current attempt at the request) is the one that is aborted, and
+        retries only get whatever remains of the original budget.
+        """
+        timed_out = []
+
+        def _expire():
+            self.msg("_withTimeout: (%(method)s) %(uri)s timed out after"
+                     " %(timeout)s seconds",
+                     method=method, uri=uri, timeout=timeout)
+            timed_out.append(True)
+            d.cancel()
+
+        call = self.reactor.callLater(timeout, _expire)
+
+        def _done(result):
+            if call.active():
+                call.cancel()
+
+            if timed_out and isinstance(result, Failure):
+                # Cancelling may surface as CancelledError or, with newer
+                # versions of Agent, ConnectingCancelledError or
+                # ResponseNeverReceived; they all mean we ran out of time
+                raise RequestTimeoutError("Request did not complete within"
+                                          " %s seconds" % (timeout,))
+
+            return result
+
+        d.addBoth(_done)
+        return d
 
     def _request(self, method, uri, headers=None, bodyProducer=None, depth=0):
         self.msg("_request depth %(depth)s (%(method)s): %(uri)s",
@@ -196,8 +259,11 @@ class KeystoneAgent(object):
                          tenant_id=self.auth_headers["X-Tenant-Id"])
 
                 # Callback all queued auth headers requests
-                while not self._headers_requests.empty():
-                    self._headers_requests.get().callback(self.auth_headers)
+                self._auth_request = None
+                waiting = self._headers_requests
+                self._headers_requests = []
+                for d in waiting:
+                    d.callback(self.auth_headers)
 
             except ValueError:
                 # We received a bad response
@@ -220,6 +286,28 @@ class KeystoneAgent(object):
                                                 " authentication credentials"
                                                 " rejected"))
 
+        def _handleAuthFailure(failure):
+            self.msg("_handleAuthFailure: %(failure)s", failure=failure)
+
+            # Let the next request start authentication again rather than
+            # queueing forever behind a request which will never finish
+            self._state = self.NOT_AUTHENTICATED
+            self._auth_request = None
+            waiting = self._headers_requests
+            self._headers_requests = []
+            for d in waiting:
+                d.errback(failure)
+
+        def _cancelWaiting(d):
+            if d in self._headers_requests:
+                self._headers_requests.remove(d)
+
+            # Nobody is left waiting for the auth request, abandon it
+            if not self._headers_requests and self._auth_request is not None:
+                self.msg("_getAuthHeaders: no requests waiting,"
+                         " cancel authentication")
+                self._auth_request.cancel()
+
         self.msg("_getAuthHeaders: state is %(state)s", state=self._state)
 
         if self._state == self.AUTHENTICATED:
@@ -234,8 +322,8 @@ class KeystoneAgent(object):
             # We cannot satisfy the auth header request immediately,
             # put it in a queue
             self.msg("_getAuthHeaders: defer, place in queue")
-            auth_headers_deferred = Deferred()
-            self._headers_requests.put(auth_headers_deferred)
+            auth_headers_deferred = Deferred(_cancelWaiting)
+            self._headers_requests.append(auth_headers_deferred)
 
             if self._state == self.NOT_AUTHENTICATED:
                 self.msg("_getAuthHeaders: not authenticated, start"
@@ -252,8 +340,9 @@ class KeystoneAgent(object):
                                            "Content-type": ["application/json"]
                                        }),
                                        self._getAuthRequestBodyProducer())
+                self._auth_request = d
                 d.addCallback(_handleAuthResponse)
-                d.addErrback(auth_headers_deferred.errback)
+                d.addErrback(_handleAuthFailure)
 
             return auth_headers_deferred
         else:
@@ -273,6 +362,10 @@ class MalformedJSONError(Exception):
     pass
 
 
+class RequestTimeoutError(Exception):
+    pass
+
+
 class StringIOReceiver(Protocol):
     """
     A protocol to aggregate chunked data as it is received, and fire a
@@ -291,3 +384,27 @@ class StringIOReceiver(Protocol):
 
     def connectionLost(self, reason):
         self.finished.callback(self.buffer.getvalue())
+
+
+def readBody(response):
+    """
+    Read the whole body of C{response}.
+
+    @return: A L{Deferred} which fires with a tuple of C{response} and its
+             body.
+    """
+    d = Deferred()
+    response.deliverBody(StringIOReceiver(d))
+    d.addCallback(lambda body: (response, body))
+    return d
+
+
+def getETag(response):
+    """
+    @return: The ETag of C{response} without any surrounding quotes, or
+             None if it doesn't have one.
+    """
+    etag = response.headers.getRawHeaders('etag')
+    if not etag:
+        return None
+    return etag[0].strip('"')
@@ -0,0 +1,296 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+
+from twisted.internet.abstract import isIPAddress
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.error import DNSLookupError
+from twisted.internet.interfaces import IResolverSimple
+from twisted.internet.threads import deferToThreadPool
+from twisted.python import log
+from twisted.python.failure import Failure
+from zope.interface import implements
+
+
+class CachingResolver(object):
+    """
+    A resolver which caches the addresses of the hosts it looks up, so
+    connections made by a L{KeystoneAgent} (to C{auth_url} and to the APIs
+    it is used with) don't each wait on a DNS lookup in the reactor's
+    thread pool.
+
+    Install it on the reactor to use it for every TCP connection::
+
+        reactor.installResolver(CachingResolver())
+
+    Cached addresses are refreshed in the background shortly before they
+    expire, as long as they are still being used, and forgotten once they
+    expire if not. If a refresh fails the old addresses continue to be
+    used, without waiting, while the refresh is retried with a backoff for
+    as long as they are still being used.
+    When a host has several addresses they are handed out in turn,
+    spreading connections over them.
+
+    @ivar hits: Number of lookups answered from the cache.
+    @ivar misses: Number of lookups which had to wait for the upstream
+                  resolver.
+    @ivar stale: Number of lookups answered with expired addresses while
+                 the upstream resolver is failing or slow.
+    """
+    implements(IResolverSimple)
+
+    def __init__(self, lookup=None, ttl=300, refresh=0.8, retry_delay=5,
+                 lookup_timeout=60, verbose=False, reactor=None):
+        """
+        @param lookup: Callable taking a host name and returning a
+                       L{Deferred} which fires with a list of its addresses.
+                       By default C{socket.gethostbyname_ex} is run in the
+                       reactor's thread pool.
+        @param ttl: Number of seconds addresses are cached for.
+        @param refresh: Fraction of C{ttl} after which addresses which have
+                        been used are refreshed in the background.
+        @param retry_delay: Seconds to wait before retrying a failed
+                            refresh, doubled after each further failure up
+                            to C{ttl}.
+        @param lookup_timeout: Seconds to wait for the upstream resolver
+                               before giving up on a lookup, so a hung
+                               lookup doesn't stop the host from ever being
+                               resolved again.
+        @param verbose: Enable verbose logging, False by default.
+        @param reactor: Reactor used to schedule refreshes, the global
+                        reactor by default.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+
+        if lookup is None:
+            lookup = self._lookup
+
+        self.lookup = lookup
+        self.ttl = ttl
+        self.refresh = refresh
+        self.retry_delay = retry_delay
+        self.lookup_timeout = lookup_timeout
+        self.verbose = verbose
+        self.reactor = reactor
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+        self._cache = {}
+        self._pending = {}
+
+    def msg(self, msg, **kwargs):
+        if self.verbose:
+            log.msg(format=msg, system="CachingResolver", **kwargs)
+
+    def getHostByName(self, name, timeout=None):
+        """
+        @param name: Host name to resolve
+        @type name: C{str}
+        @param timeout: Sequence of timeouts in seconds, as passed by
+                        L{IReactorCore.resolve}. A lookup which isn't
+                        answered from the cache fails with
+                        L{DNSLookupError} after their sum.
+        @return: A L{Deferred} which fires with one of C{name}'s addresses,
+        or fails with L{DNSLookupError}.
+        """
+        if isIPAddress(name):
+            return succeed(name)
+
+        entry = self._cache.get(name)
+
+        if entry is not None:
+            entry.used = True
+
+            if entry.expires > self.reactor.seconds():
+                self.hits += 1
+            else:
+                # The refresh failed, or hasn't finished yet. Don't make
+                # the connection wait for it, the old addresses are better
+                # than nothing
+                self.stale += 1
+                if name not in self._pending and entry.refresh is None:
+                    self._resolve(name)
+
+            return succeed(entry.next())
+
+        self.msg("getHostByName: %(name)s not cached", name=name)
+
+        d = Deferred()
+
+        if timeout:
+            timer = self.reactor.callLater(sum(timeout), self._giveUp,
+                                           name, d)
+
+            def _cancelTimer(result):
+                if timer.active():
+                    timer.cancel()
+                return result
+
+            d.addBoth(_cancelTimer)
+
+        waiting = self._pending.get(name)
+        if waiting is None:
+            self._pending[name] = [d]
+            self._resolve(name)
+        else:
+            waiting.append(d)
+        return d
+
+    def _giveUp(self, name, d):
+        """
+        Stop C{d} waiting for the lookup of C{name}, which carries on so
+        its answer can still be cached.
+        """
+        self.msg("getHostByName: %(name)s timed out", name=name)
+        self._pending[name].remove(d)
+        self.misses += 1
+        d.errback(DNSLookupError("%s: lookup timed out" % (name,)))
+
+    def _lookup(self, name):
+        d = deferToThreadPool(self.reactor, self.reactor.getThreadPool(),
+                              socket.gethostbyname_ex, name)
+        d.addCallback(lambda (hostname, aliases, addresses): addresses)
+        return d
+
+    def _resolve(self, name):
+        """
+        Look up C{name} upstream, and answer everybody waiting in
+        C{_pending} for it once the lookup is done.
+        """
+        self._pending.setdefault(name, [])
+        timed_out = []
+
+        def _timeout():
+            timed_out.append(True)
+            d.cancel()
+
+        def _done(result):
+            if timer.active():
+                timer.cancel()
+
+            if timed_out:
+                return Failure(DNSLookupError("%s: no answer after %s"
+                                              " seconds" %
+                                              (name, self.lookup_timeout)))
+            return result
+
+        def _resolved(addresses):
+            if not addresses:
+                raise DNSLookupError(name)
+
+            self._store(name, addresses)
+
+            entry = self._cache[name]
+            for waiting in self._pending.pop(name):
+                self.misses += 1
+                waiting.callback(entry.next())
+
+        def _failed(failure):
+            self.msg("_resolve: %(name)s failed (%(failure)s)",
+                     name=name, failure=failure.getErrorMessage())
+
+            for waiting in self._pending.pop(name):
+                self.misses += 1
+                waiting.errback(DNSLookupError(name))
+
+            entry = self._cache.get(name)
+            if entry is None:
+                return
+
+            if not entry.used and entry.expires <= self.reactor.seconds():
+                # Nobody has connected to this host since the refresh
+                # started, don't keep retrying it for nothing
+                self._evict(name)
+            else:
+                # Keep serving the old addresses, and try again later
+                entry.failures += 1
+                delay = min(self.retry_delay * 2 ** (entry.failures - 1),
+                            self.ttl)
+                self._schedule(name, delay)
+
+        timer = self.reactor.callLater(self.lookup_timeout, _timeout)
+        d = self.lookup(name)
+        d.addBoth(_done)
+        d.addCallback(_resolved)
+        d.addErrback(_failed)
+
+    def _store(self, name, addresses):
+        self.msg("_store: %(name)s is %(addresses)s",
+                 name=name, addresses=addresses)
+
+        entry = self._cache.get(name)
+        if entry is None:
+            entry = self._cache[name] = _CacheEntry(addresses)
+        else:
+            entry.addresses = list(addresses)
+
+        entry.expires = self.reactor.seconds() + self.ttl
+        entry.used = False
+        entry.failures = 0
+        self._schedule(name, self.ttl * self.refresh)
+
+    def _schedule(self, name, delay):
+        entry = self._cache[name]
+        if entry.refresh is not None and entry.refresh.active():
+            entry.refresh.cancel()
+        entry.refresh = self.reactor.callLater(delay, self._refresh, name)
+
+    def _evict(self, name):
+        self.msg("_evict: %(name)s unused", name=name)
+        entry = self._cache.pop(name)
+        if entry.refresh is not None and entry.refresh.active():
+            entry.refresh.cancel()
+
+    def _refresh(self, name):
+        entry = self._cache[name]
+        entry.refresh = None
+        now = self.reactor.seconds()
+
+        if not entry.used:
+            # Nobody has connected to this host since it was last looked up,
+            # forget it once it expires rather than keep resolving it forever
+            if entry.expires <= now:
+                self._evict(name)
+            else:
+                self._schedule(name, entry.expires - now)
+            return
+
+        if name not in self._pending:
+            self.msg("_refresh: %(name)s", name=name)
+            # Start counting again, so the addresses are only kept if they
+            # are used while this refresh is going on or after it
+            entry.used = False
+            self._resolve(name)
+
+
+class _CacheEntry(object):
+    """
+    The addresses of a host, handed out round-robin.
+    """
+    def __init__(self, addresses):
+        self.addresses = list(addresses)
+        self.expires = 0
+        self.used = False
+        self.failures = 0
+        self.refresh = None
+        self._next = 0
+
+    def next(self):
+        address = self.addresses[self._next % len(self.addresses)]
+        self._next += 1
+        return address
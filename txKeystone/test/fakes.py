@@ -0,0 +1,60 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+from twisted.web.resource import Resource
+
+
+class FakeKeystone(Resource):
+    """
+    Just enough of Keystone to authenticate against: POST to any path for a
+    new token, which replaces the previous one. Subclasses serve the API
+    itself, using L{authorized} to check requests' tokens.
+    """
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.tokens = 0
+        self.valid_token = None
+
+    def render_POST(self, request):
+        self.tokens += 1
+        self.valid_token = 'token%d' % (self.tokens,)
+        return json.dumps({
+            'access': {
+                'token': {
+                    'id': self.valid_token,
+                    'tenant': {'id': 'tenantId'}
+                }
+            },
+        })
+
+    def authorized(self, request):
+        """
+        @return: True if C{request} carries the current token, otherwise
+                 set a 401 response and return False.
+        """
+        if request.getHeader('x-auth-token') != self.valid_token:
+            request.setResponseCode(401)
+            return False
+        return True
+
+    def expireToken(self, request):
+        """
+        Expire the current token and reject C{request} with a 401.
+        """
+        self.valid_token = None
+        request.setResponseCode(401)
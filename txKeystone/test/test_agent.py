@@ -17,6 +17,7 @@ import mock
 from StringIO import StringIO
 
 from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
 from twisted.trial.unittest import TestCase
 from twisted.web.client import Agent, ResponseDone
 from twisted.web.http_headers import Headers
@@ -27,6 +28,7 @@ from twisted.web.test.test_webclient import (
 from zope.interface import implements
 
 from txKeystone import KeystoneAgent
+from txKeystone.keystone import RequestTimeoutError
 
 success_auth_response = json.dumps({
     'access': {
@@ -173,3 +175,121 @@ class KeystoneAgentTests(TestCase, FakeReactorAndConnectMixin):
             'https://auth.api/v2.0/tokens',
             Headers({'content-type': ['application/json']}),
             None)
+
+    def test_timeout_waiting_for_auth(self):
+        clock = Clock()
+        agent = KeystoneAgent(self.agent,
+                              'https://auth.api/v2.0/tokens',
+                              ('username', 'apikey'),
+                              reactor=clock)
+
+        d = agent.request('GET', 'https://compute.api', timeout=5)
+        auth_request = self._responses[-1]
+
+        clock.advance(5)
+
+        self.assertTrue(auth_request.called)
+        self.assertEqual(agent._state, agent.NOT_AUTHENTICATED)
+        return self.assertFailure(d, RequestTimeoutError)
+
+    def test_timeout_keeps_auth_for_other_requests(self):
+        clock = Clock()
+        agent = KeystoneAgent(self.agent,
+                              'https://auth.api/v2.0/tokens',
+                              ('username', 'apikey'),
+                              reactor=clock)
+
+        d1 = agent.request('GET', 'https://compute.api', timeout=5)
+        d2 = agent.request('GET', 'https://compute.api')
+
+        clock.advance(5)
+        self.respond(200, 'OK', None, success_auth_response)
+
+        self.assertEqual(self.agent.request.call_count, 2)
+        self.respond(200, 'OK', None, 'body')
+
+        def _check(response):
+            self.assertEqual(response.code, 200)
+
+        d2.addCallback(_check)
+        return self.assertFailure(d1, RequestTimeoutError).addCallback(
+            lambda _: d2)
+
+    def test_default_timeout_covers_request(self):
+        clock = Clock()
+        agent = KeystoneAgent(self.agent,
+                              'https://auth.api/v2.0/tokens',
+                              ('username', 'apikey'),
+                              timeout=10,
+                              reactor=clock)
+
+        d = agent.request('GET', 'https://compute.api')
+        self.respond(200, 'OK', None, success_auth_response)
+        api_request = self._responses[-1]
+
+        clock.advance(10)
+
+        self.assertTrue(api_request.called)
+        return self.assertFailure(d, RequestTimeoutError)
+
+    def test_timeout_budget_shared_with_retries(self):
+        clock = Clock()
+        agent = KeystoneAgent(self.agent,
+                              'https://auth.api/v2.0/tokens',
+                              ('username', 'apikey'),
+                              reactor=clock)
+
+        d = agent.request('GET', 'https://compute.api', timeout=10)
+        self.respond(200, 'OK', None, success_auth_response)
+
+        clock.advance(6)
+        self.respond(401, 'Unauthorized', None, '')
+        self.respond(200, 'OK', None, success_auth_response)
+
+        self.assertEqual(self.agent.request.call_count, 4)
+
+        clock.advance(4)
+
+        return self.assertFailure(d, RequestTimeoutError)
+
+    def test_timeout_cancelled_on_response(self):
+        clock = Clock()
+        agent = KeystoneAgent(self.agent,
+                              'https://auth.api/v2.0/tokens',
+                              ('username', 'apikey'),
+                              reactor=clock)
+
+        d = agent.request('GET', 'https://compute.api', timeout=5)
+        self.respond(200, 'OK', None, success_auth_response)
+        self.respond(200, 'OK', None, 'body')
+
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+        def _check(response):
+            self.assertEqual(response.code, 200)
+
+        d.addCallback(_check)
+        return d
+
+    def test_timeout_with_other_cancellation_failure(self):
+        clock = Clock()
+        agent = KeystoneAgent(self.agent,
+                              'https://auth.api/v2.0/tokens',
+                              ('username', 'apikey'),
+                              reactor=clock)
+
+        class ResponseNeverReceived(Exception):
+            pass
+
+        def _do_response(*args, **kwargs):
+            # Newer Agents fail cancelled requests with their own exceptions
+            d = Deferred(lambda d: d.errback(ResponseNeverReceived()))
+            self._responses.append(d)
+            return d
+
+        d = agent.request('GET', 'https://compute.api', timeout=5)
+        self.agent.request.side_effect = _do_response
+        self.respond(200, 'OK', None, success_auth_response)
+
+        clock.advance(5)
+        return self.assertFailure(d, RequestTimeoutError)
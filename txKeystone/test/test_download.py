@@ -0,0 +1,312 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+
+from hashlib import md5
+
+from twisted.internet import reactor
+from twisted.trial.unittest import TestCase
+from twisted.web.client import Agent, ResponseFailed
+from twisted.web.server import NOT_DONE_YET, Site
+
+from txKeystone import KeystoneAgent, RangedDownloader
+from txKeystone.download import DownloadError, ObjectModifiedError
+from txKeystone.test.fakes import FakeKeystone
+
+
+class FakeObjectStore(FakeKeystone):
+    """
+    Just enough of Swift to download an object from: HEAD or GET (with a
+    Range) any path to fetch C{data}. Ranges are ignored, and the whole of
+    C{data} returned, if C{accept_ranges} is False or for those starting at
+    an offset in C{ignore_range}. A GET whose C{If-Match} doesn't match
+    C{etag} fails with 412, as Swift's would.
+    """
+    def __init__(self, data):
+        FakeKeystone.__init__(self)
+        self.data = data
+        self.etag = md5(data).hexdigest()
+        self.headers = {}
+        self.ranges = []
+        self.truncate = set()
+        self.stall = set()
+        self.expire = set()
+        self.ignore_range = set()
+        self.accept_ranges = True
+        self.bad_range = set()
+        self.replace = set()
+
+    def render_HEAD(self, request):
+        if not self.authorized(request):
+            return ''
+
+        request.setHeader('etag', self.etag)
+        if self.accept_ranges:
+            request.setHeader('accept-ranges', 'bytes')
+        for name, value in self.headers.items():
+            request.setHeader(name, value)
+        return self.data
+
+    def render_GET(self, request):
+        if not self.authorized(request):
+            return ''
+
+        match = re.match('bytes=(\d+)-(\d+)', request.getHeader('range'))
+        start, end = int(match.group(1)), int(match.group(2))
+        self.ranges.append((start, end))
+
+        if start in self.expire:
+            # Expire the token part way through the download
+            self.expire.remove(start)
+            self.expireToken(request)
+            return ''
+
+        if start in self.replace:
+            # Somebody uploads a new version part way through the download
+            self.replace.remove(start)
+            self.data = self.data[::-1]
+            self.etag = md5(self.data).hexdigest()
+
+        if_match = request.getHeader('if-match')
+        if if_match is not None and if_match != self.etag:
+            request.setResponseCode(412)
+            return ''
+
+        if not self.accept_ranges or start in self.ignore_range:
+            self.ignore_range.discard(start)
+            return self.data
+
+        if start in self.bad_range:
+            # Send some other range
+            self.bad_range.remove(start)
+            start, end = 0, len(self.data) - 1
+
+        request.setResponseCode(206)
+        request.setHeader('content-range', 'bytes %d-%d/%d' %
+                          (start, end, len(self.data)))
+
+        if start in self.truncate:
+            # Drop the connection half way through the range
+            self.truncate.remove(start)
+            request.setHeader('content-length', str(end - start + 1))
+            request.write(self.data[start:start + (end - start + 1) / 2])
+            request.transport.loseConnection()
+            return NOT_DONE_YET
+
+        if start in self.stall:
+            # Send half the range, then nothing more
+            self.stall.remove(start)
+            request.setHeader('content-length', str(end - start + 1))
+            request.write(self.data[start:start + (end - start + 1) / 2])
+            return NOT_DONE_YET
+
+        return self.data[start:end + 1]
+
+
+class RangedDownloaderTests(TestCase):
+    def setUp(self):
+        self.data = os.urandom(10000)
+        self.store = FakeObjectStore(self.data)
+        self.port = reactor.listenTCP(0, Site(self.store),
+                                      interface='127.0.0.1')
+        base = 'http://127.0.0.1:%d' % (self.port.getHost().port,)
+
+        self.agent = KeystoneAgent(Agent(reactor),
+                                   base + '/tokens',
+                                   ('username', 'apikey'))
+        self.uri = base + '/v1/container/big'
+        self.path = self.mktemp()
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    def assertDownloaded(self):
+        f = open(self.path, 'rb')
+        try:
+            self.assertEqual(f.read(), self.data)
+        finally:
+            f.close()
+
+    def test_download(self):
+        downloader = RangedDownloader(self.agent, range_size=3000,
+                                      concurrency=2, retry_delay=0)
+
+        def _check(response):
+            self.assertEqual(response.code, 200)
+            self.assertEqual(sorted(self.store.ranges),
+                             [(0, 2999), (3000, 5999), (6000, 8999),
+                              (9000, 9999)])
+            self.assertDownloaded()
+
+        d = downloader.download(self.uri, self.path)
+        d.addCallback(_check)
+        return d
+
+    def test_range_resumed(self):
+        self.store.truncate.add(3000)
+        downloader = RangedDownloader(self.agent, range_size=3000,
+                                      retry_delay=0)
+
+        def _check(response):
+            self.assertIn((4500, 5999), self.store.ranges)
+            self.assertDownloaded()
+
+        d = downloader.download(self.uri, self.path)
+        d.addCallback(_check)
+        return d
+
+    def test_stalled_range_resumed(self):
+        self.store.stall.add(6000)
+        downloader = RangedDownloader(self.agent, range_size=3000,
+                                      idle_timeout=0.1, retry_delay=0)
+
+        def _check(response):
+            self.assertIn((7500, 8999), self.store.ranges)
+            self.assertDownloaded()
+
+        d = downloader.download(self.uri, self.path)
+        d.addCallback(_check)
+        return d
+
+    def test_range_refetched_after_reauthentication(self):
+        self.store.expire.add(6000)
+        downloader = RangedDownloader(self.agent, range_size=3000,
+                                      concurrency=1, retry_delay=0)
+
+        def _check(response):
+            self.assertEqual(self.store.tokens, 2)
+            self.assertDownloaded()
+
+        d = downloader.download(self.uri, self.path)
+        d.addCallback(_check)
+        return d
+
+    def test_range_failure(self):
+        self.store.truncate.add(9000)
+        downloader = RangedDownloader(self.agent, range_size=3000,
+                                      max_retries=1, retry_delay=0)
+
+        return self.assertFailure(downloader.download(self.uri, self.path),
+                                  ResponseFailed)
+
+    def test_whole_object_at_start_truncated(self):
+        self.store.ignore_range.add(0)
+        downloader = RangedDownloader(self.agent, range_size=3000,
+                                      retry_delay=0)
+
+        d = downloader.download(self.uri, self.path)
+        d.addCallback(lambda _: self.assertDownloaded())
+        return d
+
+    def test_whole_object_in_middle_retried(self):
+        self.store.ignore_range.add(3000)
+        downloader = RangedDownloader(self.agent, range_size=3000,
+                                      retry_delay=0)
+
+        def _check(response):
+            self.assertEqual(self.store.ranges.count((3000, 5999)), 2)
+            self.assertDownloaded()
+
+        d = downloader.download(self.uri, self.path)
+        d.addCallback(_check)
+        return d
+
+    def test_unexpected_content_range_retried(self):
+        self.store.bad_range.add(6000)
+        downloader = RangedDownloader(self.agent, range_size=3000,
+                                      retry_delay=0)
+
+        def _check(response):
+            self.assertEqual(self.store.ranges.count((6000, 8999)), 2)
+            self.assertDownloaded()
+
+        d = downloader.download(self.uri, self.path)
+        d.addCallback(_check)
+        return d
+
+    def test_ranges_not_supported(self):
+        self.store.accept_ranges = False
+        downloader = RangedDownloader(self.agent, range_size=3000,
+                                      retry_delay=0)
+
+        def _check(response):
+            self.assertEqual(self.store.ranges, [(0, 9999)])
+            self.assertDownloaded()
+
+        d = downloader.download(self.uri, self.path)
+        d.addCallback(_check)
+        return d
+
+    def test_object_replaced(self):
+        self.store.replace.add(6000)
+        downloader = RangedDownloader(self.agent, range_size=3000,
+                                      concurrency=1, retry_delay=0)
+
+        def _check(_):
+            self.assertEqual(self.store.ranges,
+                             [(0, 2999), (3000, 5999), (6000, 8999)])
+
+        d = self.assertFailure(downloader.download(self.uri, self.path),
+                               ObjectModifiedError)
+        d.addCallback(_check)
+        return d
+
+    def test_object_replaced_not_verified(self):
+        self.store.etag = '"%s"' % (md5('segment-etags').hexdigest(),)
+        self.store.headers['x-static-large-object'] = 'True'
+        self.store.replace.add(3000)
+        downloader = RangedDownloader(self.agent, range_size=3000,
+                                      verify=False, retry_delay=0)
+
+        return self.assertFailure(downloader.download(self.uri, self.path),
+                                  ObjectModifiedError)
+
+    def test_etag_mismatch(self):
+        self.store.etag = md5('something else').hexdigest()
+        downloader = RangedDownloader(self.agent, range_size=3000,
+                                      retry_delay=0)
+
+        return self.assertFailure(downloader.download(self.uri, self.path),
+                                  DownloadError)
+
+    def test_etag_not_verified(self):
+        self.store.etag = md5('something else').hexdigest()
+        downloader = RangedDownloader(self.agent, range_size=3000,
+                                      verify=False, retry_delay=0)
+
+        d = downloader.download(self.uri, self.path)
+        d.addCallback(lambda _: self.assertDownloaded())
+        return d
+
+    def test_static_large_object_not_verified(self):
+        self.store.etag = '"%s"' % (md5('segment-etags').hexdigest(),)
+        self.store.headers['x-static-large-object'] = 'True'
+        downloader = RangedDownloader(self.agent, range_size=3000,
+                                      retry_delay=0)
+
+        d = downloader.download(self.uri, self.path)
+        d.addCallback(lambda _: self.assertDownloaded())
+        return d
+
+    def test_dynamic_large_object_not_verified(self):
+        self.store.etag = '"%s"' % (md5('segment-etags').hexdigest(),)
+        self.store.headers['x-object-manifest'] = 'container/big/'
+        downloader = RangedDownloader(self.agent, range_size=3000,
+                                      retry_delay=0)
+
+        d = downloader.download(self.uri, self.path)
+        d.addCallback(lambda _: self.assertDownloaded())
+        return d
@@ -0,0 +1,242 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet.defer import Deferred
+from twisted.internet.error import DNSLookupError
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from txKeystone import CachingResolver
+
+
+class StubResolver(object):
+    """
+    An upstream resolver whose lookups are answered by the test.
+    """
+    def __init__(self):
+        self.lookups = []
+
+    def __call__(self, name):
+        d = Deferred()
+        self.lookups.append((name, d))
+        return d
+
+    def answer(self, *addresses):
+        self.lookups.pop(0)[1].callback(list(addresses))
+
+    def fail(self):
+        self.lookups.pop(0)[1].errback(DNSLookupError('stub'))
+
+
+class CachingResolverTests(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.upstream = StubResolver()
+        self.resolver = CachingResolver(self.upstream, ttl=100,
+                                        reactor=self.clock)
+
+    def resolve(self, name='auth.api', timeout=None):
+        results = []
+        self.resolver.getHostByName(name, timeout).addBoth(results.append)
+        return results
+
+    def test_ip_address_not_looked_up(self):
+        self.assertEqual(self.resolve('127.0.0.1'), ['127.0.0.1'])
+        self.assertEqual(self.upstream.lookups, [])
+
+    def test_miss_then_hit(self):
+        first = self.resolve()
+        self.upstream.answer('10.0.0.1')
+
+        self.assertEqual(first, ['10.0.0.1'])
+        self.assertEqual(self.resolve(), ['10.0.0.1'])
+        self.assertEqual(self.upstream.lookups, [])
+        self.assertEqual((self.resolver.hits, self.resolver.misses), (1, 1))
+
+    def test_concurrent_misses_share_lookup(self):
+        first = self.resolve()
+        second = self.resolve()
+        self.assertEqual(len(self.upstream.lookups), 1)
+
+        self.upstream.answer('10.0.0.1')
+
+        self.assertEqual(first + second, ['10.0.0.1', '10.0.0.1'])
+        self.assertEqual(self.resolver.misses, 2)
+
+    def test_round_robin(self):
+        self.resolve()
+        self.upstream.answer('10.0.0.1', '10.0.0.2', '10.0.0.3')
+
+        results = []
+        for i in range(3):
+            results.extend(self.resolve())
+
+        self.assertEqual(results, ['10.0.0.2', '10.0.0.3', '10.0.0.1'])
+
+    def test_refreshed_before_expiry(self):
+        self.resolve()
+        self.upstream.answer('10.0.0.1')
+        self.resolve()
+
+        self.clock.advance(80)
+        self.assertEqual(len(self.upstream.lookups), 1)
+        self.assertEqual(self.resolve(), ['10.0.0.1'])
+
+        self.upstream.answer('10.0.0.2')
+        self.clock.advance(30)
+
+        self.assertEqual(self.resolve(), ['10.0.0.2'])
+        self.assertEqual(self.upstream.lookups, [])
+
+    def test_unused_not_refreshed(self):
+        self.resolve()
+        self.upstream.answer('10.0.0.1')
+
+        self.clock.advance(80)
+        self.assertEqual(self.upstream.lookups, [])
+
+    def test_stale_served_when_refresh_fails(self):
+        self.resolve()
+        self.upstream.answer('10.0.0.1')
+        self.resolve()
+
+        self.clock.advance(80)
+        self.upstream.fail()
+        self.resolve()
+        self.clock.advance(30)
+
+        # Answered straight away, while the retried refresh (started
+        # after the first failure) is still going
+        self.assertEqual(len(self.upstream.lookups), 1)
+        self.assertEqual(self.resolve(), ['10.0.0.1'])
+        self.assertEqual(len(self.upstream.lookups), 1)
+        self.assertEqual(self.resolver.stale, 1)
+
+    def test_unused_not_retried(self):
+        self.resolve()
+        self.upstream.answer('10.0.0.1')
+        self.resolve()
+
+        self.clock.advance(80)
+        self.upstream.fail()
+        self.clock.advance(20)
+
+        self.assertEqual(self.upstream.lookups, [])
+        self.assertEqual(self.resolver._cache, {})
+
+    def test_failed_refresh_retried_with_backoff(self):
+        self.resolve()
+        self.upstream.answer('10.0.0.1')
+        self.resolve()
+
+        self.clock.advance(80)
+        self.upstream.fail()
+
+        for delay in (5, 10, 20):
+            self.resolve()
+            self.clock.advance(delay - 1)
+            self.assertEqual(self.upstream.lookups, [])
+            self.clock.advance(1)
+            self.assertEqual(len(self.upstream.lookups), 1)
+            if delay < 20:
+                self.upstream.fail()
+
+        self.upstream.answer('10.0.0.2')
+
+        self.assertEqual(self.resolve(), ['10.0.0.2'])
+        self.assertEqual((self.resolver.hits, self.resolver.stale), (5, 0))
+
+    def test_unused_evicted(self):
+        self.resolve()
+        self.upstream.answer('10.0.0.1')
+
+        self.clock.advance(100)
+        self.assertEqual(self.resolver._cache, {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        self.resolve()
+        self.assertEqual(len(self.upstream.lookups), 1)
+
+    def test_unused_evicted_after_failed_refresh(self):
+        self.resolve()
+        self.upstream.answer('10.0.0.1')
+        self.resolve()
+
+        self.clock.advance(80)
+        self.upstream.fail()
+        self.resolve()
+
+        # The retry is still going when the addresses expire, and nobody
+        # has used them since it started, so they are forgotten rather
+        # than retried forever
+        self.clock.advance(21)
+        self.upstream.fail()
+
+        self.clock.advance(20000)
+        self.assertEqual(self.upstream.lookups, [])
+        self.assertEqual(self.resolver._cache, {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_hung_lookup_abandoned(self):
+        results = self.resolve()
+
+        self.clock.advance(60)
+        results[0].trap(DNSLookupError)
+        self.assertEqual(self.resolver._pending, {})
+
+        # The next lookup starts afresh instead of waiting on the hung one
+        results = self.resolve()
+        self.assertEqual(len(self.upstream.lookups), 2)
+        self.upstream.lookups.pop(0)
+        self.upstream.answer('10.0.0.1')
+        self.assertEqual(results, ['10.0.0.1'])
+
+    def test_hung_refresh_abandoned(self):
+        self.resolve()
+        self.upstream.answer('10.0.0.1')
+        self.resolve()
+
+        self.clock.advance(80)
+        self.upstream.lookups.pop(0)
+        self.resolve()
+        self.clock.advance(60)
+
+        # Retried after the timeout, like any other failed refresh
+        self.clock.advance(5)
+        self.assertEqual(len(self.upstream.lookups), 1)
+
+    def test_caller_timeout(self):
+        first = self.resolve(timeout=(1, 3))
+        second = self.resolve()
+
+        self.clock.advance(4)
+        first[0].trap(DNSLookupError)
+        self.assertEqual(second, [])
+
+        self.upstream.answer('10.0.0.1')
+        self.assertEqual(second, ['10.0.0.1'])
+        self.assertEqual(self.clock.getDelayedCalls()[0].func,
+                         self.resolver._refresh)
+
+    def test_failure_without_cached_addresses(self):
+        results = self.resolve()
+        self.upstream.fail()
+
+        results[0].trap(DNSLookupError)
+
+    def test_empty_answer(self):
+        results = self.resolve()
+        self.upstream.answer()
+
+        results[0].trap(DNSLookupError)
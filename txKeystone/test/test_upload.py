@@ -0,0 +1,349 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import mock
+import os
+
+from hashlib import md5
+from StringIO import StringIO
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.error import ConnectionRefusedError
+from twisted.internet.task import Cooperator
+from twisted.trial.unittest import TestCase
+from twisted.web.client import Agent
+from twisted.web.server import Site
+from twisted.web.test.test_webclient import FileConsumer
+
+from txKeystone import KeystoneAgent, SegmentedUploader
+from txKeystone.upload import (UploadError, _FileSegment,
+                               _SegmentBodyProducer)
+from txKeystone.test.fakes import FakeKeystone
+
+
+class FakeObjectStore(FakeKeystone):
+    """
+    Just enough of Swift to upload objects to: PUT to
+    /v1/<container>/<object> to store. Like Swift's, static large object
+    manifests referring to empty segments are rejected.
+    """
+    def __init__(self):
+        FakeKeystone.__init__(self)
+        self.objects = {}
+        self.headers = {}
+        self.puts = []
+        self.fail = {}
+        self.refuse = {}
+        self.expire = set()
+
+    def render_PUT(self, request):
+        if not self.authorized(request):
+            return ''
+
+        if request.path in self.expire:
+            # Expire the token part way through the upload
+            self.expire.remove(request.path)
+            self.expireToken(request)
+            return ''
+
+        self.puts.append(request.path)
+
+        if self.fail.get(request.path):
+            self.fail[request.path] -= 1
+            request.setResponseCode(500)
+            return ''
+
+        if request.path in self.refuse:
+            request.setResponseCode(self.refuse[request.path])
+            return ''
+
+        body = request.content.read()
+        path = request.path
+        if request.args.get('multipart-manifest') == ['put']:
+            path += '?multipart-manifest=put'
+            if [segment for segment in json.loads(body)
+                    if segment['size_bytes'] == 0]:
+                request.setResponseCode(400)
+                return ''
+
+        self.objects[path] = body
+        self.headers[path] = request.requestHeaders
+        request.setHeader('etag', '"%s"' % (md5(body).hexdigest(),))
+        request.setResponseCode(201)
+        return ''
+
+
+class SegmentedUploaderTests(TestCase):
+    def setUp(self):
+        self.store = FakeObjectStore()
+        self.port = reactor.listenTCP(0, Site(self.store),
+                                      interface='127.0.0.1')
+        base = 'http://127.0.0.1:%d' % (self.port.getHost().port,)
+
+        self.agent = KeystoneAgent(Agent(reactor),
+                                   base + '/tokens',
+                                   ('username', 'apikey'))
+        self.container_url = base + '/v1/container'
+
+        self.path = self.mktemp()
+        self.data = os.urandom(10000)
+        f = open(self.path, 'wb')
+        f.write(self.data)
+        f.close()
+
+    def tearDown(self):
+        if self.port.connected:
+            return self.port.stopListening()
+
+    def segmentPath(self, index):
+        return '/v1/container/big/10000/3000/%08d' % (index,)
+
+    def assertSegments(self):
+        segments = [self.store.objects[self.segmentPath(i)]
+                    for i in range(4)]
+        self.assertEqual([len(s) for s in segments], [3000, 3000, 3000, 1000])
+        self.assertEqual(''.join(segments), self.data)
+
+    def test_upload_slo(self):
+        uploader = SegmentedUploader(self.agent, segment_size=3000,
+                                     concurrency=2, retry_delay=0)
+
+        def _check(response):
+            self.assertEqual(response.code, 201)
+            self.assertSegments()
+
+            manifest = json.loads(
+                self.store.objects['/v1/container/big'
+                                   '?multipart-manifest=put'])
+            self.assertEqual(
+                manifest,
+                [{'path': '/container/big/10000/3000/%08d' % (i,),
+                  'etag': md5(self.data[i * 3000:(i + 1) * 3000]).hexdigest(),
+                  'size_bytes': len(self.data[i * 3000:(i + 1) * 3000])}
+                 for i in range(4)])
+
+        d = uploader.upload(self.path, self.container_url, 'big')
+        d.addCallback(_check)
+        return d
+
+    def test_upload_dlo(self):
+        uploader = SegmentedUploader(self.agent, segment_size=3000,
+                                     manifest='dlo', retry_delay=0)
+
+        def _check(response):
+            self.assertEqual(response.code, 201)
+            self.assertSegments()
+            self.assertEqual(self.store.objects['/v1/container/big'], '')
+            self.assertEqual(
+                self.store.headers['/v1/container/big'].getRawHeaders(
+                    'x-object-manifest'),
+                ['container/big/10000/3000/'])
+
+        d = uploader.upload(self.path, self.container_url, 'big')
+        d.addCallback(_check)
+        return d
+
+    def test_segments_enlarged_to_fit_manifest(self):
+        uploader = SegmentedUploader(self.agent, segment_size=1000,
+                                     max_segments=4, retry_delay=0)
+
+        def _check(response):
+            self.assertEqual(response.code, 201)
+
+            manifest = json.loads(
+                self.store.objects['/v1/container/big'
+                                   '?multipart-manifest=put'])
+            self.assertEqual([(s['path'], s['size_bytes']) for s in manifest],
+                             [('/container/big/10000/2500/%08d' % (i,), 2500)
+                              for i in range(4)])
+
+        d = uploader.upload(self.path, self.container_url, 'big')
+        d.addCallback(_check)
+        return d
+
+    def test_too_big_for_manifest(self):
+        uploader = SegmentedUploader(self.agent, segment_size=1000,
+                                     max_segments=4, retry_delay=0)
+        uploader.MAX_SEGMENT_SIZE = 2000
+
+        def _check(_):
+            self.assertEqual(self.store.puts, [])
+
+        d = self.assertFailure(
+            uploader.upload(self.path, self.container_url, 'big'),
+            UploadError)
+        d.addCallback(_check)
+        return d
+
+    def test_segment_retried(self):
+        self.store.fail[self.segmentPath(1)] = 2
+        uploader = SegmentedUploader(self.agent, segment_size=3000,
+                                     retry_delay=0)
+
+        def _check(response):
+            self.assertEqual(response.code, 201)
+            self.assertSegments()
+
+        d = uploader.upload(self.path, self.container_url, 'big')
+        d.addCallback(_check)
+        return d
+
+    def test_segment_resent_after_reauthentication(self):
+        self.store.expire.add(self.segmentPath(2))
+        uploader = SegmentedUploader(self.agent, segment_size=3000,
+                                     concurrency=1, retry_delay=0)
+
+        def _check(response):
+            self.assertEqual(response.code, 201)
+            self.assertEqual(self.store.tokens, 2)
+            self.assertSegments()
+
+        d = uploader.upload(self.path, self.container_url, 'big')
+        d.addCallback(_check)
+        return d
+
+    def test_segment_failure(self):
+        self.store.fail[self.segmentPath(3)] = 3
+        uploader = SegmentedUploader(self.agent, segment_size=3000,
+                                     retry_delay=0)
+
+        def _check(_):
+            self.assertNotIn('/v1/container/big?multipart-manifest=put',
+                             self.store.objects)
+
+        d = self.assertFailure(
+            uploader.upload(self.path, self.container_url, 'big'),
+            UploadError)
+        d.addCallback(_check)
+        return d
+
+    def test_refused_segment_not_retried(self):
+        self.store.refuse[self.segmentPath(1)] = 403
+        uploader = SegmentedUploader(self.agent, segment_size=3000,
+                                     retry_delay=0)
+
+        def _check(_):
+            self.assertEqual(self.store.puts.count(self.segmentPath(1)), 1)
+
+        d = self.assertFailure(
+            uploader.upload(self.path, self.container_url, 'big'),
+            UploadError)
+        d.addCallback(_check)
+        return d
+
+    def test_empty_file(self):
+        open(self.path, 'wb').close()
+        uploader = SegmentedUploader(self.agent, segment_size=3000,
+                                     retry_delay=0)
+
+        def _check(response):
+            self.assertEqual(response.code, 201)
+            self.assertEqual(self.store.objects, {'/v1/container/big': ''})
+
+        d = uploader.upload(self.path, self.container_url, 'big')
+        d.addCallback(_check)
+        return d
+
+    def test_transport_failure_passed_through(self):
+        uploader = SegmentedUploader(self.agent, segment_size=3000,
+                                     max_retries=1, retry_delay=0)
+
+        d = self.port.stopListening()
+        d.addCallback(lambda _: uploader.upload(self.path,
+                                                self.container_url, 'big'))
+        return self.assertFailure(d, ConnectionRefusedError)
+
+    def test_concurrency(self):
+        agent = mock.Mock(KeystoneAgent)
+        agent.request.side_effect = lambda *args, **kwargs: Deferred()
+
+        uploader = SegmentedUploader(agent, segment_size=1000,
+                                     concurrency=3)
+        uploader.upload(self.path, self.container_url, 'big')
+
+        self.assertEqual(agent.request.call_count, 3)
+
+
+class SegmentBodyProducerTests(TestCase):
+    def setUp(self):
+        self.path = self.mktemp()
+        self.data = os.urandom(1000)
+        f = open(self.path, 'wb')
+        f.write(self.data)
+        f.close()
+
+        self.inputFile = open(self.path, 'rb')
+        self.addCleanup(self.inputFile.close)
+        self.segment = _FileSegment(self.inputFile, 'big/00000000',
+                                    100, 500)
+
+        self._scheduled = []
+        self.cooperator = Cooperator(
+            terminationPredicateFactory=lambda: lambda: True,
+            scheduler=self._scheduled.append)
+
+    def runProductions(self):
+        """
+        Run everything scheduled by the cooperator, interleaving the
+        productions one chunk at a time, until they have all finished.
+        """
+        while self._scheduled:
+            self._scheduled.pop(0)()
+
+    def test_overlapping_productions(self):
+        producer = _SegmentBodyProducer(self.segment,
+                                        cooperator=self.cooperator,
+                                        readSize=64)
+
+        first = StringIO()
+        firstDone = producer.startProducing(FileConsumer(first))
+        self._scheduled.pop(0)()
+
+        # Resent (after a 401) while the first body is still being sent
+        second = StringIO()
+        secondDone = producer.startProducing(FileConsumer(second))
+        self.runProductions()
+
+        self.assertFailure(firstDone, UploadError)
+        self.assertEqual(second.getvalue(), self.data[100:600])
+        self.assertEqual(producer.etag, md5(self.data[100:600]).hexdigest())
+        return secondDone
+
+    def test_separate_producers(self):
+        producers = [_SegmentBodyProducer(self.segment,
+                                          cooperator=self.cooperator,
+                                          readSize=64)
+                     for i in range(2)]
+        outputs = [StringIO(), StringIO()]
+
+        for producer, output in zip(producers, outputs):
+            producer.startProducing(FileConsumer(output))
+            self._scheduled.pop(0)()
+        self.runProductions()
+
+        for producer, output in zip(producers, outputs):
+            self.assertEqual(output.getvalue(), self.data[100:600])
+            self.assertEqual(producer.etag,
+                             md5(self.data[100:600]).hexdigest())
+
+    def test_etag_unset_until_finished(self):
+        producer = _SegmentBodyProducer(self.segment,
+                                        cooperator=self.cooperator,
+                                        readSize=64)
+        producer.startProducing(FileConsumer(StringIO()))
+        self._scheduled.pop(0)()
+
+        self.assertIdentical(producer.etag, None)
@@ -0,0 +1,477 @@
+# Copyright 2012 Rackspace Hosting, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import urllib
+
+try:
+    import simplejson as json
+except:
+    import json
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+from cStringIO import StringIO
+from twisted.internet import task
+from twisted.internet.defer import (Deferred, DeferredList,
+                                    DeferredSemaphore, fail)
+from twisted.internet.task import deferLater
+from twisted.web.client import FileBodyProducer
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IBodyProducer
+from twisted.python import log
+from zope.interface import implements
+
+from txKeystone.keystone import getETag, readBody
+
+
+class SegmentedUploader(object):
+    """
+    Uploads large files to an object store (Swift / Cloud Files) as a number
+    of segments PUT in parallel through a L{KeystoneAgent}, followed by a
+    manifest which joins them into a single object.
+
+    The source file is read in fixed size chunks as each segment is sent, so
+    at most C{concurrency} chunks are held in memory at once. Segments are
+    retried individually, so a failure (or an expired token) part way
+    through only costs the segment which was in flight. Only server errors
+    and lost connections are retried; a segment the server refuses (any
+    other 4xx) fails the upload straight away.
+
+    An empty file is uploaded as a plain, empty object, since Swift won't
+    accept a manifest referring to an empty segment.
+
+    @cvar SEGMENT_SIZE: Default segment size in bytes.
+    @cvar CONCURRENCY: Default number of segments uploaded at once.
+    @cvar MAX_RETRIES: Default number of attempts made for each segment
+                       before failing the upload.
+    @cvar MAX_SEGMENTS: Default maximum number of segments in a static large
+                        object manifest, Swift's C{max_manifest_segments}.
+    @cvar MAX_SEGMENT_SIZE: Largest segment Swift accepts, in bytes.
+    """
+    SEGMENT_SIZE = 100 * 1024 * 1024
+    CONCURRENCY = 4
+    MAX_RETRIES = 3
+    MAX_SEGMENTS = 1000
+    MAX_SEGMENT_SIZE = 5 * 1024 * 1024 * 1024
+
+    SLO = 'slo'
+    DLO = 'dlo'
+
+    def __init__(self, agent, segment_size=None, concurrency=None,
+                 max_retries=None, manifest='slo', retry_delay=1.0,
+                 timeout=None, max_segments=None, verbose=False,
+                 reactor=None):
+        """
+        @param agent: L{KeystoneAgent} used to make requests
+        @param segment_size: Size of each segment in bytes. A static large
+                             object whose file would need more than
+                             C{max_segments} segments of this size is
+                             uploaded in larger segments instead.
+        @param concurrency: Maximum number of segments uploaded at once.
+        @param max_retries: Maximum number of attempts for each segment.
+        @param manifest: Either slo (static large object) or dlo (dynamic
+                         large object), depending on the kind of manifest
+                         you want written.
+        @param retry_delay: Seconds to wait before retrying a segment.
+        @param timeout: Deadline in seconds for each segment request, passed
+                        on to L{KeystoneAgent.request}.
+        @param max_segments: Maximum number of segments the object store
+                             accepts in a static large object manifest.
+        @param verbose: Enable verbose logging, False by default.
+        @param reactor: Reactor used to schedule retries, the global
+                        reactor by default.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+
+        if manifest not in (self.SLO, self.DLO):
+            raise ValueError("manifest must be either %r or %r" %
+                             (self.SLO, self.DLO))
+
+        self.agent = agent
+        self.segment_size = segment_size or self.SEGMENT_SIZE
+        self.concurrency = concurrency or self.CONCURRENCY
+        self.max_retries = max_retries or self.MAX_RETRIES
+        self.manifest = manifest
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.max_segments = max_segments or self.MAX_SEGMENTS
+        self.verbose = verbose
+        self.reactor = reactor
+
+    def msg(self, msg, **kwargs):
+        if self.verbose:
+            log.msg(format=msg, system="SegmentedUploader", **kwargs)
+
+    def upload(self, path, container_url, object_name):
+        """
+        @param path: Path of the local file to upload
+        @type path: C{str}
+        @param container_url: URL of the container to upload to, e.g.
+        https://storage.api/v1/AUTH_tenant/container
+        @type container_url: C{str}
+        @param object_name: Name of the object to create in the container.
+        Segments are stored in the same container, under
+        object_name/size/segment_size/.
+        @type object_name: C{str}
+        @return: A L{Deferred} which fires with the manifest L{Response}
+        once all segments and the manifest have been written (or with the
+        L{Response} to the PUT of an empty file). It fails with
+        L{UploadError} if the server rejects a segment or the manifest, or a
+        segment's ETag doesn't match what was sent, and before anything is
+        sent if the file is too big for a static large object even in
+        segments of C{MAX_SEGMENT_SIZE}. Other failures, such as
+        a connection which is lost once too often or a file which can't be
+        read, are passed through unchanged.
+        """
+        container_url = container_url.rstrip('/')
+        container = urllib.unquote(container_url.rsplit('/', 1)[-1])
+
+        try:
+            inputFile = open(path, 'rb')
+            size = os.fstat(inputFile.fileno()).st_size
+        except (IOError, OSError), e:
+            return fail(e)
+
+        if size == 0:
+            inputFile.close()
+            self.msg("upload: %(path)s is empty", path=path)
+            return self._putEmpty(container_url, object_name)
+
+        segment_size = self.segment_size
+        if self.manifest == self.SLO:
+            # The manifest would be rejected, once every segment had been
+            # sent, if it listed too many of them
+            needed = -(-size // self.max_segments)
+            if needed > self.MAX_SEGMENT_SIZE:
+                inputFile.close()
+                return fail(UploadError("%s is too big for a static large"
+                                        " object: %d bytes" %
+                                        (path, size)))
+            if needed > segment_size:
+                self.msg("upload: %(path)s needs %(size)s byte segments",
+                         path=path, size=needed)
+                segment_size = needed
+
+        prefix = '%s/%d/%d/' % (object_name, size, segment_size)
+        segments = []
+        for index, offset in enumerate(range(0, size, segment_size)):
+            segments.append(_FileSegment(inputFile,
+                                         prefix + '%08d' % (index,),
+                                         offset,
+                                         min(segment_size, size - offset)))
+
+        self.msg("upload: %(path)s (%(size)s bytes) to %(object)s in"
+                 " %(count)s segments",
+                 path=path, size=size, object=object_name,
+                 count=len(segments))
+
+        semaphore = DeferredSemaphore(self.concurrency)
+        failed = []
+
+        def _uploadSegment(segment):
+            if failed:
+                # Another segment has already failed the upload,
+                # don't bother sending the rest
+                return fail(UploadError("Upload of %s abandoned" %
+                                        (segment.name,)))
+
+            d = self._putSegment(container_url, segment)
+
+            def _segmentFailed(failure):
+                failed.append(failure)
+                return failure
+
+            d.addErrback(_segmentFailed)
+            return d
+
+        dl = DeferredList([semaphore.run(_uploadSegment, segment)
+                           for segment in segments],
+                          consumeErrors=True)
+
+        def _segmentsDone(_):
+            # Wait for every segment in flight to finish with the file
+            # before closing it, even if the upload has already failed
+            inputFile.close()
+
+            if failed:
+                return failed[0]
+
+            return self._putManifest(container_url, container,
+                                     object_name, prefix, segments)
+
+        dl.addCallback(_segmentsDone)
+        return dl
+
+    def _request(self, method, uri, headers, bodyProducer=None):
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+
+        d = self.agent.request(method, uri, headers, bodyProducer, **kwargs)
+        d.addCallback(readBody)
+        return d
+
+    def _putSegment(self, container_url, segment, attempt=1):
+        self.msg("_putSegment attempt %(attempt)s: %(name)s",
+                 attempt=attempt, name=segment.name)
+
+        uri = '%s/%s' % (container_url, urllib.quote(segment.name))
+        refused = []
+
+        def _checkResponse((response, body)):
+            if response.code not in (201, 202):
+                if 400 <= response.code < 500 and response.code != 401:
+                    # Sending it again won't change the server's mind.
+                    # (A 401 is what's left after KeystoneAgent's own
+                    # attempt to reauthenticate, which may do better
+                    # next time.)
+                    refused.append(True)
+                raise UploadError("Segment %s rejected: %s %s" %
+                                  (segment.name, response.code,
+                                   response.phrase))
+
+            sent = producer.etag
+            if sent is None:
+                raise UploadError("Segment %s accepted before it was"
+                                  " completely sent" % (segment.name,))
+
+            etag = getETag(response)
+            if etag is not None and etag != sent:
+                raise UploadError("Segment %s corrupted in transit: sent %s"
+                                  " received %s" %
+                                  (segment.name, sent, etag))
+
+            segment.etag = sent
+            return response
+
+        def _retry(failure):
+            # The body may still be being sent, after the response arrived
+            # or the request timed out; stop it before starting another
+            producer.abandon()
+
+            if refused or attempt >= self.max_retries:
+                self.msg("_putSegment: %(name)s failed after %(attempt)s"
+                         " attempts", name=segment.name, attempt=attempt)
+                return failure
+
+            self.msg("_putSegment: %(name)s failed (%(failure)s), retrying",
+                     name=segment.name, failure=failure.getErrorMessage())
+
+            return deferLater(self.reactor, self.retry_delay,
+                              self._putSegment, container_url, segment,
+                              attempt + 1)
+
+        producer = _SegmentBodyProducer(segment)
+        d = self._request('PUT', uri, Headers({}), producer)
+        d.addCallback(_checkResponse)
+        d.addErrback(_retry)
+        return d
+
+    def _putEmpty(self, container_url, object_name):
+        uri = '%s/%s' % (container_url, urllib.quote(object_name))
+
+        self.msg("_putEmpty: %(uri)s", uri=uri)
+
+        def _checkResponse((response, body)):
+            if response.code not in (201, 202):
+                raise UploadError("%s rejected: %s %s" %
+                                  (object_name, response.code,
+                                   response.phrase))
+            return response
+
+        d = self._request('PUT', uri, Headers({}),
+                          FileBodyProducer(StringIO('')))
+        d.addCallback(_checkResponse)
+        return d
+
+    def _putManifest(self, container_url, container, object_name, prefix,
+                     segments):
+        uri = '%s/%s' % (container_url, urllib.quote(object_name))
+
+        if self.manifest == self.SLO:
+            uri += '?multipart-manifest=put'
+            headers = Headers({"Content-type": ["application/json"]})
+            body = json.dumps([{"path": '/%s/%s' % (container, segment.name),
+                                "etag": segment.etag,
+                                "size_bytes": segment.length}
+                               for segment in segments])
+        else:
+            headers = Headers({"X-Object-Manifest":
+                               ['%s/%s' % (urllib.quote(container),
+                                           urllib.quote(prefix))]})
+            body = ''
+
+        self.msg("_putManifest: %(uri)s", uri=uri)
+
+        def _checkResponse((response, body)):
+            if response.code not in (201, 202):
+                raise UploadError("Manifest for %s rejected: %s %s" %
+                                  (object_name, response.code,
+                                   response.phrase))
+            return response
+
+        d = self._request('PUT', uri, headers,
+                          FileBodyProducer(StringIO(body)))
+        d.addCallback(_checkResponse)
+        return d
+
+
+class UploadError(Exception):
+    pass
+
+
+class _FileSegment(object):
+    """
+    C{length} bytes of a shared file starting at C{offset}, to be uploaded
+    as the segment C{name}.
+
+    @ivar etag: MD5 of the segment, once it has been uploaded.
+    """
+    def __init__(self, inputFile, name, offset, length):
+        self.inputFile = inputFile
+        self.name = name
+        self.offset = offset
+        self.length = length
+        self.etag = None
+
+
+class _SegmentReader(object):
+    """
+    A read only file-like view of a L{_FileSegment}, which keeps the MD5 of
+    the bytes read through it.
+
+    Every read seeks the underlying file first, so any number of readers of
+    the same file can be used at once, each with its own position.
+    """
+    def __init__(self, segment):
+        self.segment = segment
+        self.etag = None
+
+        self._position = 0
+        self._md5 = md5()
+
+    def read(self, size=-1):
+        segment = self.segment
+        remaining = segment.length - self._position
+        if size < 0 or size > remaining:
+            size = remaining
+
+        data = ''
+        if size > 0:
+            segment.inputFile.seek(segment.offset + self._position)
+            data = segment.inputFile.read(size)
+
+            self._position += len(data)
+            self._md5.update(data)
+
+        if self._position == segment.length:
+            self.etag = self._md5.hexdigest()
+
+        return data
+
+
+class _SegmentBodyProducer(object):
+    """
+    Produces the body of a L{_FileSegment}, reading it a chunk at a time
+    like L{FileBodyProducer}.
+
+    Each call to L{startProducing} reads the segment from the beginning
+    through its own L{_SegmentReader}, so L{KeystoneAgent} can resend it
+    after reauthenticating. Twisted may still be sending the previous body
+    when that happens (the response can arrive before the body is
+    finished); that attempt is of no further use, so it is abandoned.
+
+    @ivar etag: MD5 of the segment as sent by the last attempt which
+                finished, or None.
+    """
+    implements(IBodyProducer)
+
+    def __init__(self, segment, cooperator=task, readSize=2 ** 16):
+        self.segment = segment
+        self.length = segment.length
+        self.etag = None
+
+        self._cooperate = cooperator.cooperate
+        self._readSize = readSize
+        self._production = None
+
+    def startProducing(self, consumer):
+        self.abandon()
+
+        reader = _SegmentReader(self.segment)
+        production = self._cooperate(self._writeloop(reader, consumer))
+        finished = Deferred()
+        self._production = (production, finished)
+
+        def _done(_):
+            if self._production is not None and \
+                    self._production[0] is production:
+                self._production = None
+            self.etag = reader.etag
+            finished.callback(None)
+
+        def _failed(reason):
+            if reason.check(task.TaskStopped):
+                # Stopped by abandon, which has already failed finished, or
+                # by stopProducing, after which finished must not fire
+                return
+
+            if self._production is not None and \
+                    self._production[0] is production:
+                self._production = None
+            finished.errback(reason)
+
+        production.whenDone().addCallbacks(_done, _failed)
+        return finished
+
+    def _writeloop(self, reader, consumer):
+        while True:
+            data = reader.read(self._readSize)
+            if not data:
+                break
+            consumer.write(data)
+            yield None
+
+    def abandon(self):
+        """
+        Stop sending the body currently being produced, if any, and fail
+        the L{Deferred} returned by L{startProducing} for it.
+        """
+        if self._production is None:
+            return
+
+        production, finished = self._production
+        self._production = None
+        production.stop()
+        finished.errback(UploadError("Sending segment %s abandoned" %
+                                     (self.segment.name,)))
+
+    def stopProducing(self):
+        if self._production is not None:
+            production, finished = self._production
+            self._production = None
+            production.stop()
+
+    def pauseProducing(self):
+        if self._production is not None:
+            self._production[0].pause()
+
+    def resumeProducing(self):
+        if self._production is not None:
+            self._production[0].resume()